@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Counterparty index for MoMo SMS Financial Tracker
+Maps free-text names and phone fragments to canonical party ids and keeps a
+time-ordered ledger with running totals for every party
+"""
+
+import os
+import re
+import sys
+from bisect import bisect_left, bisect_right
+from typing import List, Dict, Any, Optional
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from dsa.parser import extract_counterparty_phone
+
+# Placeholders the parser uses for "no counterparty"
+_NOT_A_PARTY = {"", "you", "unknown"}
+# Parser leftovers after the real name, e.g. "Bundles and Packs with token  has been completed at"
+_NAME_TAIL = re.compile(r'\s+(?:with token|has been|on your)\b.*$', re.IGNORECASE)
+
+
+def normalize_name(name: str) -> str:
+    """Clean up a counterparty name as extracted from an SMS body"""
+    name = _NAME_TAIL.sub("", name or "")
+    return " ".join(name.split()).strip(" (:.,")
+
+
+def normalize_phone(token: str) -> str:
+    """Full numbers keep all digits, masked ones (*********013) keep the visible suffix"""
+    digits = re.sub(r'\D', "", token or "")
+    if token and "*" in token:
+        return "x" + digits
+    return digits
+
+
+def _slug(text: str) -> str:
+    return re.sub(r'[^a-z0-9]+', "-", text.casefold()).strip("-")
+
+
+class PartyIndex:
+    """
+    Counterparty lookup (party id -> party) plus one ledger per party
+    Ledger entries are ordered by (txn_date, txn_id) and carry running totals
+    """
+
+    def __init__(self):
+        self.parties: Dict[str, Dict[str, Any]] = {}
+        self.ledgers: Dict[str, List[Dict[str, Any]]] = {}
+        self._ledger_keys: Dict[str, List[tuple]] = {}
+        self._party_by_phone: Dict[str, str] = {}
+        self._party_by_txn: Dict[str, str] = {}
+
+    def build(self, transactions: List[Dict[str, Any]]):
+        """Rebuild the whole index from a list of transactions"""
+        self.__init__()
+        for transaction in sorted(transactions, key=self._sort_key):
+            self.add(transaction)
+
+    @staticmethod
+    def _tx_id(transaction: Dict[str, Any]) -> str:
+        return str(transaction.get("txn_id", transaction.get("id", "")))
+
+    @classmethod
+    def _sort_key(cls, transaction: Dict[str, Any]) -> tuple:
+        tx_id = cls._tx_id(transaction)
+        return (transaction.get("txn_date") or 0, int(tx_id) if tx_id.isdigit() else 0)
+
+    def _resolve(self, transaction: Dict[str, Any]):
+        """Return (party_id, name, phone, direction) for a transaction, or None"""
+        sender = str(transaction.get("sender") or "")
+        receiver = str(transaction.get("receiver") or "")
+        if sender.strip().lower() == "you":
+            name, direction = receiver, "sent"
+        elif receiver.strip().lower() == "you":
+            name, direction = sender, "received"
+        else:
+            return None
+
+        name = normalize_name(name)
+        phone = extract_counterparty_phone(transaction.get("raw_message", ""))
+        phone = normalize_phone(phone) if phone else None
+
+        if name.lower() not in _NOT_A_PARTY:
+            party_id = _slug(name)
+        elif phone:
+            # No usable name: fall back to a party already seen with this phone
+            party_id = self._party_by_phone.get(phone, "phone-" + phone)
+            name = phone
+        else:
+            return None
+
+        if not party_id:
+            return None
+        return party_id, name, phone, direction
+
+    def add(self, transaction: Dict[str, Any]) -> Optional[str]:
+        """Index one transaction, returning its party id (None if it has no counterparty)"""
+        resolved = self._resolve(transaction)
+        if not resolved:
+            return None
+        party_id, name, phone, direction = resolved
+
+        party = self.parties.get(party_id)
+        if party is None:
+            party = {"id": party_id, "name": name, "phones": []}
+            self.parties[party_id] = party
+            self.ledgers[party_id] = []
+            self._ledger_keys[party_id] = []
+        if phone and phone not in party["phones"]:
+            party["phones"].append(phone)
+            self._party_by_phone.setdefault(phone, party_id)
+
+        key = self._sort_key(transaction)
+        keys = self._ledger_keys[party_id]
+        position = bisect_right(keys, key)
+        keys.insert(position, key)
+        self.ledgers[party_id].insert(position, {
+            "direction": direction,
+            "amount": float(transaction.get("amount", 0.0)),
+            "transaction": transaction,
+        })
+        self._party_by_txn[self._tx_id(transaction)] = party_id
+        self._update_running_totals(party_id, position)
+        return party_id
+
+    def remove(self, tx_id: str) -> bool:
+        """Drop a transaction from its party ledger"""
+        party_id = self._party_by_txn.pop(str(tx_id), None)
+        if party_id is None:
+            return False
+
+        ledger = self.ledgers[party_id]
+        keys = self._ledger_keys[party_id]
+        position = next(i for i, entry in enumerate(ledger)
+                        if self._tx_id(entry["transaction"]) == str(tx_id))
+        del ledger[position]
+        del keys[position]
+
+        if not ledger:
+            party = self.parties.pop(party_id)
+            del self.ledgers[party_id]
+            del self._ledger_keys[party_id]
+            for phone in party["phones"]:
+                if self._party_by_phone.get(phone) == party_id:
+                    del self._party_by_phone[phone]
+        else:
+            self._update_running_totals(party_id, position)
+        return True
+
+    def _update_running_totals(self, party_id: str, start: int):
+        """Recompute running totals from `start` to the end of the ledger"""
+        ledger = self.ledgers[party_id]
+        if start > 0:
+            previous = ledger[start - 1]
+            total_sent, total_received = previous["total_sent"], previous["total_received"]
+        else:
+            total_sent = total_received = 0.0
+
+        for entry in ledger[start:]:
+            if entry["direction"] == "sent":
+                total_sent += entry["amount"]
+            else:
+                total_received += entry["amount"]
+            entry["total_sent"] = total_sent
+            entry["total_received"] = total_received
+            entry["net"] = total_received - total_sent
+
+    def get_parties(self) -> List[Dict[str, Any]]:
+        """Summaries of all parties, sorted by name"""
+        return [self.get_party(party_id) for party_id in
+                sorted(self.parties, key=lambda pid: self.parties[pid]["name"].casefold())]
+
+    def get_party(self, party_id: str) -> Optional[Dict[str, Any]]:
+        """Summary of one party: totals come from the last ledger entry"""
+        party = self.parties.get(party_id)
+        if party is None:
+            return None
+        ledger = self.ledgers[party_id]
+        last = ledger[-1]
+        return {
+            "id": party["id"],
+            "name": party["name"],
+            "phones": list(party["phones"]),
+            "transaction_count": len(ledger),
+            "total_sent": last["total_sent"],
+            "total_received": last["total_received"],
+            "net": last["net"],
+            "first_txn_date": self._ledger_keys[party_id][0][0],
+            "last_txn_date": self._ledger_keys[party_id][-1][0],
+        }
+
+    def get_ledger(self, party_id: str, date_from: int = None, date_to: int = None) -> Optional[List[Dict[str, Any]]]:
+        """Ledger entries of one party, optionally limited to a txn_date range"""
+        ledger = self.ledgers.get(party_id)
+        if ledger is None:
+            return None
+        keys = self._ledger_keys[party_id]
+        start = bisect_left(keys, (date_from,)) if date_from is not None else 0
+        end = bisect_left(keys, (date_to + 1,)) if date_to is not None else len(keys)
+        return ledger[start:end]
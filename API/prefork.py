@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Pre-fork multi-process serving for the MoMo SMS Financial Tracker API
+
+The owner (parent) process parses the XML once, then forks worker processes
+that share one listening socket. Workers inherit the parsed dataset through
+fork (copy-on-write pages, frozen against the garbage collector) instead of
+re-parsing the XML. Every write is forwarded to the owner, which writes the
+resulting change to the operation log (one small file per generation) and
+bumps a shared generation counter; workers replay the new entries on their
+next request, or within half a second when idle.
+
+A reload is logged as the full list of transactions. Each worker unpickles
+its own private copy of it and rebuilds its own indexes; after a reload the
+dataset is no longer shared between processes.
+
+Workers report the generation they have applied, and the owner deletes log
+files once every worker has moved past them.
+"""
+
+import gc
+import multiprocessing
+import os
+import pickle
+import shutil
+import signal
+import tempfile
+from multiprocessing.connection import wait
+from typing import Any, Dict, Optional
+
+from transaction_manager import TransactionManager
+
+# Manager methods that change data and must run in the owner process
+WRITE_OPERATIONS = ("add_transaction", "update_transaction", "delete_transaction", "reload_from_xml")
+
+# How often (seconds) the owner looks for log files every worker has applied
+PRUNE_INTERVAL = 1.0
+
+
+def _log_path(log_dir: str, generation: int) -> str:
+    return os.path.join(log_dir, f"op-{generation}.pickle")
+
+
+def write_log_entry(log_dir: str, generation: int, entry: tuple):
+    """Atomically publish the change that makes up `generation`"""
+    path = _log_path(log_dir, generation)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_log_entry(log_dir: str, generation: int) -> tuple:
+    """Load the change that makes up `generation`"""
+    with open(_log_path(log_dir, generation), "rb") as f:
+        return pickle.load(f)
+
+
+def _log_entry(manager: TransactionManager, operation: str, args: tuple, result) -> Optional[tuple]:
+    """Describe the effect of a successful write so workers can replay it"""
+    if operation in ("add_transaction", "update_transaction"):
+        # Ship the finished record: ids and timestamps are decided by the owner
+        return ("put", dict(result)) if result else None
+    if operation == "delete_transaction":
+        return ("delete", str(args[0])) if result else None
+    if operation == "reload_from_xml":
+        return ("reload", manager.transactions)
+    return None
+
+
+class WorkerTransactionManager:
+    """
+    Transaction manager used inside worker processes
+    Reads are served from the local copy, writes go to the owner process
+    """
+
+    def __init__(self, conn, generation, applied, index: int, log_dir: str, manager: TransactionManager):
+        self._conn = conn
+        self._generation = generation
+        self._applied = applied
+        self._index = index
+        self._log_dir = log_dir
+        self._manager = manager
+
+    def _current(self) -> TransactionManager:
+        """Return the local view after replaying any writes it has not seen yet"""
+        target = self._generation.value
+        applied = self._applied[self._index]
+        if target != applied:
+            for generation in range(applied + 1, target + 1):
+                action, payload = read_log_entry(self._log_dir, generation)
+                if action == "put":
+                    self._manager.apply_record(payload)
+                elif action == "delete":
+                    self._manager.delete_transaction(payload)
+                elif action == "reload":
+                    self._manager = TransactionManager(transactions=payload)
+            # Tell the owner these log files are no longer needed by this worker
+            self._applied[self._index] = target
+        return self._manager
+
+    def _call_owner(self, operation: str, *args):
+        """Send a write to the owner process and wait for its result"""
+        self._conn.send((operation, args))
+        ok, result = self._conn.recv()
+        if not ok:
+            raise result
+        return result
+
+    def add_transaction(self, transaction_data: Dict[str, Any]) -> Dict[str, Any]:
+        return self._call_owner("add_transaction", transaction_data)
+
+    def update_transaction(self, tx_id: str, update_data: Dict[str, Any]):
+        return self._call_owner("update_transaction", tx_id, update_data)
+
+    def delete_transaction(self, tx_id: str) -> bool:
+        return self._call_owner("delete_transaction", tx_id)
+
+    def reload_from_xml(self) -> int:
+        return self._call_owner("reload_from_xml")
+
+    def __getattr__(self, name):
+        # Every read-only method is answered from the local view
+        return getattr(self._current(), name)
+
+
+def _raise_shutdown(signum, frame):
+    raise SystemExit(0)
+
+
+def _worker_main(server, handler_class, manager, conn, generation, applied, index, log_dir):
+    """Entry point of a worker process: serve requests on the inherited socket"""
+    signal.signal(signal.SIGTERM, _raise_shutdown)
+    worker_manager = WorkerTransactionManager(conn, generation, applied, index, log_dir, manager)
+    handler_class.set_transaction_manager(worker_manager)
+    # serve_forever calls this between polls, so idle workers keep up with the log too
+    server.service_actions = worker_manager._current
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _prune_log(log_dir: str, applied, pruned: int) -> int:
+    """Delete log files every live worker has applied, returning the new pruned generation"""
+    live = [value for value in applied if value >= 0]
+    oldest = min(live) if live else pruned
+    for generation in range(pruned + 1, oldest + 1):
+        try:
+            os.remove(_log_path(log_dir, generation))
+        except FileNotFoundError:
+            pass
+    return max(pruned, oldest)
+
+
+def _owner_loop(manager: TransactionManager, connections: Dict[Any, int], generation, applied, log_dir: str):
+    """Apply writes forwarded by workers and log each change for the workers to replay"""
+    pruned = 0
+    while connections:
+        for conn in wait(list(connections), timeout=PRUNE_INTERVAL):
+            try:
+                operation, args = conn.recv()
+            except EOFError:
+                # A worker that is gone must not hold back pruning
+                applied[connections.pop(conn)] = -1
+                continue
+
+            if operation not in WRITE_OPERATIONS:
+                conn.send((False, RuntimeError(f"Unsupported operation: {operation}")))
+                continue
+
+            # Manager writes validate their input before changing anything,
+            # so a failed write has nothing to publish
+            try:
+                result = getattr(manager, operation)(*args)
+            except Exception as e:
+                conn.send((False, e))
+                continue
+
+            entry = _log_entry(manager, operation, args, result)
+            if entry:
+                write_log_entry(log_dir, generation.value + 1, entry)
+                with generation.get_lock():
+                    generation.value += 1
+            conn.send((True, result))
+
+        pruned = _prune_log(log_dir, applied, pruned)
+
+
+def serve_prefork(server, handler_class, manager: TransactionManager, workers: int = None):
+    """
+    Serve `server` from several forked worker processes sharing its socket
+    The calling process becomes the owner of `manager` and handles all writes
+    """
+    workers = workers or os.cpu_count() or 1
+    ctx = multiprocessing.get_context("fork")
+
+    log_dir = tempfile.mkdtemp(prefix="momo_oplog_")
+    generation = ctx.Value("q", 0)
+    # Last generation each worker has applied (-1 once the worker is gone)
+    applied = ctx.Array("q", workers, lock=False)
+
+    processes = []
+    owner_connections = {}
+    # Stop the workers and clean up on `kill` as well as on Ctrl+C
+    previous_handler = signal.signal(signal.SIGTERM, _raise_shutdown)
+    try:
+        # Keep the collector from touching (and so copying) the inherited dataset
+        gc.freeze()
+        for index in range(workers):
+            owner_conn, worker_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker_main,
+                args=(server, handler_class, manager, worker_conn, generation, applied, index, log_dir),
+                daemon=True,
+            )
+            process.start()
+            worker_conn.close()
+            processes.append(process)
+            owner_connections[owner_conn] = index
+        gc.unfreeze()
+
+        print(f"Started {workers} worker processes")
+        _owner_loop(manager, owner_connections, generation, applied, log_dir)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        server.server_close()
+        shutil.rmtree(log_dir, ignore_errors=True)
+        signal.signal(signal.SIGTERM, previous_handler)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Balance reconciliation for MoMo SMS Financial Tracker
+Walks transactions in time order, predicts each "new balance" from the
+previous one plus the amount and fee, and flags where the SMS history does
+not add up: balance gaps (missing SMS), duplicates and out-of-order SMS
+"""
+
+from typing import List, Dict, Any, Optional
+
+# Transaction types that add to / take from the account balance
+INFLOW_TYPES = {"received", "deposit"}
+OUTFLOW_TYPES = {"payment", "transfer", "airtime", "withdrawal"}
+
+# Balances are whole RWF; anything within this is a match
+TOLERANCE = 0.5
+
+# The same payment can arrive as two SMS in different formats a few seconds apart
+DUPLICATE_WINDOW_MS = 2 * 60 * 1000
+
+
+def _tx_id(transaction: Dict[str, Any]) -> str:
+    return str(transaction.get("txn_id", transaction.get("id", "")))
+
+
+def _sort_key(transaction: Dict[str, Any]) -> tuple:
+    tx_id = _tx_id(transaction)
+    return (transaction.get("txn_date") or 0, int(tx_id) if tx_id.isdigit() else 0)
+
+
+def _signed_delta(transaction: Dict[str, Any]) -> Optional[float]:
+    """Balance change caused by a transaction (None when the direction is unknown)"""
+    tx_type = transaction.get("transaction_type")
+    amount = float(transaction.get("amount") or 0.0)
+    if tx_type in INFLOW_TYPES:
+        return amount
+    if tx_type in OUTFLOW_TYPES:
+        return -(amount + float(transaction.get("fee") or 0.0))
+    return None
+
+
+def _duplicate_keys(transaction: Dict[str, Any]) -> List[tuple]:
+    """Keys under which two records count as the same SMS"""
+    keys = []
+    sms_id = str(transaction.get("transaction_id") or "")
+    # Without an id in the SMS the parser falls back to the record's own id
+    if sms_id and sms_id != _tx_id(transaction):
+        keys.append(("sms_id", sms_id))
+    body = transaction.get("raw_message")
+    if body:
+        # The balance (or the date when there is none) tells repeated purchases apart
+        balance = transaction.get("balance")
+        keys.append(("body", body, balance if balance is not None else transaction.get("txn_date")))
+    return keys
+
+
+def _effect_key(transaction: Dict[str, Any]) -> Optional[tuple]:
+    """Format-independent key: the balance change and the balance it led to"""
+    delta = _signed_delta(transaction)
+    balance = transaction.get("balance")
+    if delta is None or balance is None:
+        return None
+    return (delta, balance)
+
+
+def _add(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    return None if a is None or b is None else a + b
+
+
+def _close(a: Optional[float], b: Optional[float]) -> bool:
+    return a is not None and b is not None and abs(a - b) <= TOLERANCE
+
+
+def reconcile(transactions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Reconcile reported balances against amounts and fees in one ordered pass
+    Returns a summary plus a list of issues ordered by date
+    """
+    issues = []
+
+    # Drop duplicates first so they do not also show up as balance gaps
+    ordered = []
+    seen: Dict[tuple, str] = {}
+    seen_effects: Dict[tuple, tuple] = {}
+    for transaction in sorted(transactions, key=_sort_key):
+        keys = _duplicate_keys(transaction)
+        original = next((seen[key] for key in keys if key in seen), None)
+        effect = _effect_key(transaction)
+        txn_date = transaction.get("txn_date") or 0
+        if original is None and effect in seen_effects:
+            # Same amount and resulting balance moments apart: one payment, two SMS formats
+            effect_date, effect_id = seen_effects[effect]
+            if txn_date - effect_date <= DUPLICATE_WINDOW_MS:
+                original = effect_id
+        if original is not None:
+            issues.append({
+                "type": "duplicate",
+                "id": _tx_id(transaction),
+                "transaction_id": transaction.get("transaction_id", ""),
+                "txn_date": transaction.get("txn_date"),
+                "related_id": original,
+            })
+            continue
+        for key in keys:
+            seen[key] = _tx_id(transaction)
+        if effect is not None:
+            seen_effects[effect] = (txn_date, _tx_id(transaction))
+        ordered.append(transaction)
+
+    # Column view of the history
+    reported = [t.get("balance") for t in ordered]
+    deltas = [_signed_delta(t) for t in ordered]
+
+    # Balance before each record is the previous record's reported figure. A
+    # record without one (e.g. "Your new balance: ." SMS) breaks the chain
+    # instead of carrying a guess forward, so the next record is unverified
+    balance_before = [None] + reported[:-1]
+    expected = [_add(before, delta) for before, delta in zip(balance_before, deltas)]
+    mismatch = [
+        exp is not None and rep is not None and not _close(exp, rep)
+        for exp, rep in zip(expected, reported)
+    ]
+
+    count = len(ordered)
+    i = 0
+    while i < count:
+        if not mismatch[i]:
+            i += 1
+            continue
+
+        transaction = ordered[i]
+        # Two SMS delivered in the wrong order: swapping them makes both balances agree
+        if (i + 1 < count and mismatch[i + 1]
+                and _close(_add(balance_before[i], deltas[i + 1]), reported[i + 1])
+                and _close(_add(reported[i + 1], deltas[i]), reported[i])):
+            issues.append({
+                "type": "out_of_order",
+                "id": _tx_id(transaction),
+                "transaction_id": transaction.get("transaction_id", ""),
+                "txn_date": transaction.get("txn_date"),
+                "related_id": _tx_id(ordered[i + 1]),
+            })
+            # After the swap the record that follows continues from this balance
+            if i + 2 < count and deltas[i + 2] is not None and reported[i + 2] is not None:
+                expected[i + 2] = reported[i] + deltas[i + 2]
+                mismatch[i + 2] = not _close(expected[i + 2], reported[i + 2])
+            i += 2
+            continue
+
+        # Unexplained jump: one or more SMS are missing before this record
+        issues.append({
+            "type": "balance_gap",
+            "id": _tx_id(transaction),
+            "transaction_id": transaction.get("transaction_id", ""),
+            "txn_date": transaction.get("txn_date"),
+            "related_id": _tx_id(ordered[i - 1]) if i > 0 else None,
+            "expected_balance": expected[i],
+            "reported_balance": reported[i],
+            "difference": reported[i] - expected[i],
+        })
+        i += 1
+
+    issues.sort(key=lambda issue: (issue["txn_date"] or 0, issue["id"]))
+    summary = {"duplicate": 0, "balance_gap": 0, "out_of_order": 0}
+    for issue in issues:
+        summary[issue["type"]] += 1
+
+    known_balances = [balance for balance in reported if balance is not None]
+    return {
+        "transactions": len(transactions),
+        "verified": sum(1 for exp, rep in zip(expected, reported) if exp is not None and rep is not None),
+        "unverified": sum(1 for exp, rep in zip(expected, reported) if exp is None or rep is None),
+        "opening_balance": known_balances[0] if known_balances else None,
+        "closing_balance": known_balances[-1] if known_balances else None,
+        "unexplained_total": sum(issue["difference"] for issue in issues if issue["type"] == "balance_gap"),
+        "summary": summary,
+        "issues": issues,
+    }
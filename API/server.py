@@ -1,11 +1,18 @@
+import argparse
 import base64
 import json
+import os
 import re
-from datetime import datetime
+import sys
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
 from transaction_manager import get_transaction_manager
 
+# Add parent directory to path to import the parser's date helpers
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dsa.parser import millis_to_iso, stamp_to_iso
+
 # Authentication credentials
 USERNAME = "admin"
 PASSWORD = "password123"
@@ -26,6 +33,25 @@ def parse_basic_auth(header):
         return None
 
 
+def format_timestamp(value, render=millis_to_iso):
+    """Render a stored epoch-millisecond date as ISO (older string values pass through)"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return render(int(value))
+    return value or ""
+
+
+def format_stamp(value):
+    """Render created_at/updated_at, which whole batches share, through a cache"""
+    return format_timestamp(value, stamp_to_iso)
+
+
+# Query parameters accepted by GET /transactions
+SEARCH_FILTERS = (
+    "date_from", "date_to", "amount_min", "amount_max",
+    "transaction_type", "status", "sender", "receiver", "sort"
+)
+
+
 class RequestHandler(BaseHTTPRequestHandler):
     """HTTP request handler for MoMo SMS Financial Tracker API"""
     
@@ -92,10 +118,22 @@ class RequestHandler(BaseHTTPRequestHandler):
         if not self._authorize():
             return
 
-        # GET /transactions - List all transactions
-        if self.path == "/transactions":
+        url = urlparse(self.path)
+
+        # GET /transactions - List all transactions (optionally filtered/sorted)
+        if url.path == "/transactions":
             try:
-                transactions = self.transaction_manager.get_all_transactions()
+                query = parse_qs(url.query)
+                filters = {key: values[-1] for key, values in query.items() if key in SEARCH_FILTERS}
+                if filters:
+                    # Only the query parameters can be invalid, not the stored data
+                    try:
+                        transactions = self.transaction_manager.search_transactions(**filters)
+                    except ValueError as e:
+                        self._send_json(HTTPStatus.BAD_REQUEST, {"error": f"Invalid query parameter: {str(e)}"})
+                        return
+                else:
+                    transactions = self.transaction_manager.get_all_transactions()
                 # Convert to API format
                 api_transactions = []
                 for tx in transactions:
@@ -104,12 +142,14 @@ class RequestHandler(BaseHTTPRequestHandler):
                         "transaction_id": tx.get("transaction_id", ""),
                         "transaction_type": tx.get("transaction_type", "unknown"),
                         "amount": float(tx.get("amount", 0.0)),
+                        "fee": tx.get("fee"),
+                        "balance": tx.get("balance"),
                         "sender": tx.get("sender", "Unknown"),
                         "receiver": tx.get("receiver", "Unknown"),
-                        "timestamp": tx.get("txn_date", tx.get("timestamp", "")),
+                        "timestamp": format_timestamp(tx.get("txn_date", tx.get("timestamp", ""))),
                         "status": tx.get("status", "completed"),
                         "raw_message": tx.get("raw_message", ""),
-                        "created_at": tx.get("created_at", "")
+                        "created_at": format_stamp(tx.get("created_at", ""))
                     }
                     api_transactions.append(api_tx)
                 
@@ -120,7 +160,7 @@ class RequestHandler(BaseHTTPRequestHandler):
                 return
 
         # GET /transactions/{id} - Get specific transaction
-        match = re.fullmatch(r"/transactions/([^/]+)", self.path)
+        match = re.fullmatch(r"/transactions/([^/]+)", url.path)
         if match:
             tx_id = match.group(1)
             try:
@@ -135,13 +175,15 @@ class RequestHandler(BaseHTTPRequestHandler):
                     "transaction_id": transaction.get("transaction_id", ""),
                     "transaction_type": transaction.get("transaction_type", "unknown"),
                     "amount": float(transaction.get("amount", 0.0)),
+                    "fee": transaction.get("fee"),
+                    "balance": transaction.get("balance"),
                     "sender": transaction.get("sender", "Unknown"),
                     "receiver": transaction.get("receiver", "Unknown"),
-                    "timestamp": transaction.get("txn_date", transaction.get("timestamp", "")),
+                    "timestamp": format_timestamp(transaction.get("txn_date", transaction.get("timestamp", ""))),
                     "status": transaction.get("status", "completed"),
                     "raw_message": transaction.get("raw_message", ""),
-                    "created_at": transaction.get("created_at", ""),
-                    "updated_at": transaction.get("updated_at", "")
+                    "created_at": format_stamp(transaction.get("created_at", "")),
+                    "updated_at": format_stamp(transaction.get("updated_at", ""))
                 }
                 
                 self._send_json(HTTPStatus.OK, api_tx)
@@ -150,8 +192,76 @@ class RequestHandler(BaseHTTPRequestHandler):
                 self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"Failed to get transaction: {str(e)}"})
                 return
 
+        # GET /parties - List counterparties with their totals
+        if url.path == "/parties":
+            try:
+                parties = self.transaction_manager.get_parties()
+                for party in parties:
+                    party["first_txn_date"] = format_timestamp(party["first_txn_date"])
+                    party["last_txn_date"] = format_timestamp(party["last_txn_date"])
+                self._send_json(HTTPStatus.OK, parties)
+                return
+            except Exception as e:
+                self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"Failed to get parties: {str(e)}"})
+                return
+
+        # GET /parties/{id}/transactions - Time-ordered ledger of one counterparty
+        match = re.fullmatch(r"/parties/([^/]+)/transactions", url.path)
+        if match:
+            party_id = match.group(1)
+            try:
+                query = parse_qs(url.query)
+                try:
+                    ledger = self.transaction_manager.get_party_ledger(
+                        party_id,
+                        query.get("date_from", [None])[-1],
+                        query.get("date_to", [None])[-1],
+                    )
+                except ValueError as e:
+                    self._send_json(HTTPStatus.BAD_REQUEST, {"error": f"Invalid query parameter: {str(e)}"})
+                    return
+                if ledger is None:
+                    self._send_json(HTTPStatus.NOT_FOUND, {"error": "Party not found"})
+                    return
+
+                api_ledger = []
+                for entry in ledger:
+                    tx = entry["transaction"]
+                    api_ledger.append({
+                        "id": str(tx.get("txn_id", tx.get("id", ""))),
+                        "transaction_id": tx.get("transaction_id", ""),
+                        "transaction_type": tx.get("transaction_type", "unknown"),
+                        "timestamp": format_timestamp(tx.get("txn_date", "")),
+                        "direction": entry["direction"],
+                        "amount": entry["amount"],
+                        "total_sent": entry["total_sent"],
+                        "total_received": entry["total_received"],
+                        "net": entry["net"]
+                    })
+
+                self._send_json(HTTPStatus.OK, api_ledger)
+                return
+            except Exception as e:
+                self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"Failed to get party transactions: {str(e)}"})
+                return
+
+        # GET /reconciliation - Check SMS balances for gaps, duplicates and ordering problems
+        if url.path == "/reconciliation":
+            try:
+                report = self.transaction_manager.get_reconciliation()
+                # The report is cached by the manager, so format a copy
+                api_report = dict(report)
+                api_report["issues"] = [
+                    dict(issue, txn_date=format_timestamp(issue["txn_date"])) for issue in report["issues"]
+                ]
+                self._send_json(HTTPStatus.OK, api_report)
+                return
+            except Exception as e:
+                self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"Failed to reconcile transactions: {str(e)}"})
+                return
+
         # GET /stats - Get transaction statistics (bonus endpoint)
-        if self.path == "/stats":
+        if url.path == "/stats":
             try:
                 stats = self.transaction_manager.get_transaction_stats()
                 self._send_json(HTTPStatus.OK, stats)
@@ -185,8 +295,12 @@ class RequestHandler(BaseHTTPRequestHandler):
                     })
                     return
 
-                # Create transaction
-                new_transaction = self.transaction_manager.add_transaction(data)
+                # Create transaction (the manager rejects invalid fields before storing anything)
+                try:
+                    new_transaction = self.transaction_manager.add_transaction(data)
+                except ValueError as e:
+                    self._send_json(HTTPStatus.BAD_REQUEST, {"error": f"Invalid transaction data: {str(e)}"})
+                    return
                 
                 # Convert to API format
                 api_tx = {
@@ -194,12 +308,14 @@ class RequestHandler(BaseHTTPRequestHandler):
                     "transaction_id": new_transaction.get("transaction_id", ""),
                     "transaction_type": new_transaction.get("transaction_type", "unknown"),
                     "amount": float(new_transaction.get("amount", 0.0)),
+                    "fee": new_transaction.get("fee"),
+                    "balance": new_transaction.get("balance"),
                     "sender": new_transaction.get("sender", "Unknown"),
                     "receiver": new_transaction.get("receiver", "Unknown"),
-                    "timestamp": new_transaction.get("txn_date", ""),
+                    "timestamp": format_timestamp(new_transaction.get("txn_date", "")),
                     "status": new_transaction.get("status", "pending"),
                     "raw_message": new_transaction.get("raw_message", ""),
-                    "created_at": new_transaction.get("created_at", "")
+                    "created_at": format_stamp(new_transaction.get("created_at", ""))
                 }
                 
                 self._send_json(HTTPStatus.CREATED, api_tx)
@@ -226,7 +342,11 @@ class RequestHandler(BaseHTTPRequestHandler):
                     self._send_json(HTTPStatus.BAD_REQUEST, {"error": "No data provided"})
                     return
 
-                updated_transaction = self.transaction_manager.update_transaction(tx_id, data)
+                try:
+                    updated_transaction = self.transaction_manager.update_transaction(tx_id, data)
+                except ValueError as e:
+                    self._send_json(HTTPStatus.BAD_REQUEST, {"error": f"Invalid transaction data: {str(e)}"})
+                    return
                 if not updated_transaction:
                     self._send_json(HTTPStatus.NOT_FOUND, {"error": "Transaction not found"})
                     return
@@ -237,13 +357,15 @@ class RequestHandler(BaseHTTPRequestHandler):
                     "transaction_id": updated_transaction.get("transaction_id", ""),
                     "transaction_type": updated_transaction.get("transaction_type", "unknown"),
                     "amount": float(updated_transaction.get("amount", 0.0)),
+                    "fee": updated_transaction.get("fee"),
+                    "balance": updated_transaction.get("balance"),
                     "sender": updated_transaction.get("sender", "Unknown"),
                     "receiver": updated_transaction.get("receiver", "Unknown"),
-                    "timestamp": updated_transaction.get("txn_date", ""),
+                    "timestamp": format_timestamp(updated_transaction.get("txn_date", "")),
                     "status": updated_transaction.get("status", "completed"),
                     "raw_message": updated_transaction.get("raw_message", ""),
-                    "created_at": updated_transaction.get("created_at", ""),
-                    "updated_at": updated_transaction.get("updated_at", "")
+                    "created_at": format_stamp(updated_transaction.get("created_at", "")),
+                    "updated_at": format_stamp(updated_transaction.get("updated_at", ""))
                 }
                 
                 self._send_json(HTTPStatus.OK, api_tx)
@@ -284,8 +406,8 @@ class RequestHandler(BaseHTTPRequestHandler):
         return
 
 
-def run(host="127.0.0.1", port=8000):
-    """Start the HTTP server"""
+def run(host="127.0.0.1", port=8000, workers=1):
+    """Start the HTTP server (workers > 1 serves from pre-forked processes)"""
     try:
         # Initialize transaction manager
         manager = get_transaction_manager()
@@ -298,16 +420,25 @@ def run(host="127.0.0.1", port=8000):
         server = HTTPServer((host, port), RequestHandler)
         print(f"MoMo SMS Financial Tracker API running on http://{host}:{port}")
         print("Available endpoints:")
-        print("  GET    /transactions     - List all transactions")
+        print("  GET    /transactions     - List all transactions (?date_from=&date_to=&sort=date)")
         print("  GET    /transactions/{id} - Get specific transaction")
         print("  POST   /transactions     - Create new transaction")
         print("  PUT    /transactions/{id} - Update transaction")
         print("  DELETE /transactions/{id} - Delete transaction")
         print("  GET    /stats           - Get transaction statistics")
+        print("  GET    /reconciliation  - Balance gaps, duplicates and out-of-order SMS")
+        print("  GET    /parties         - List counterparties")
+        print("  GET    /parties/{id}/transactions - Ledger of one counterparty")
         print(f"Authentication: {USERNAME} / {PASSWORD}")
         print("\nPress Ctrl+C to stop the server")
         
-        server.serve_forever()
+        if workers > 1 and hasattr(os, "fork"):
+            from prefork import serve_prefork
+            serve_prefork(server, RequestHandler, manager, workers)
+        else:
+            if workers > 1:
+                print("Multi-process mode needs fork(); running a single process")
+            server.serve_forever()
     except KeyboardInterrupt:
         print("\nServer stopped")
     except Exception as e:
@@ -315,4 +446,10 @@ def run(host="127.0.0.1", port=8000):
 
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="MoMo SMS Financial Tracker API")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8000)
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="number of worker processes (0 = one per CPU core)")
+    args = arg_parser.parse_args()
+    run(args.host, args.port, args.workers or os.cpu_count() or 1)
\ No newline at end of file
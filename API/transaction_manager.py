@@ -7,12 +7,25 @@ Handles transaction data in memory, eliminating need for large JSON files
 import json
 import os
 import sys
-from datetime import datetime
 from typing import List, Dict, Any, Optional
 
 # Add parent directory to path to import parser
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from dsa.parser import parse_sms_xml
+from dsa.parser import (
+    parse_sms_xml_mmap, now_millis, to_epoch_millis, extract_balance, extract_fee
+)
+from party_index import PartyIndex
+from reconciliation import reconcile
+
+# Free-text fields: the party index and the SMS extractors expect strings
+TEXT_FIELDS = ("transaction_id", "sender", "receiver", "transaction_type", "status", "raw_message")
+
+
+def _text_value(field: str, value: Any) -> str:
+    """Validate a free-text field value (ValueError for anything but a string)"""
+    if not isinstance(value, str):
+        raise ValueError(f"{field} must be a string")
+    return value
 
 
 class TransactionManager:
@@ -21,38 +34,51 @@ class TransactionManager:
     Loads data from XML once, keeps in memory for fast access
     """
     
-    def __init__(self, xml_file_path: str = None):
+    def __init__(self, xml_file_path: str = None, transactions: List[Dict[str, Any]] = None):
         self.xml_file_path = xml_file_path or os.path.join(os.path.dirname(__file__), "modified_sms_v2.xml")
         self.transactions: List[Dict[str, Any]] = []
         self.transactions_by_id: Dict[str, Dict[str, Any]] = {}
+        self.party_index = PartyIndex()
+        self._reconciliation: Optional[Dict[str, Any]] = None
         self._next_id = 1
-        self._load_transactions()
+        if transactions is not None:
+            # Already-parsed records (e.g. a worker's shared snapshot), skip the XML
+            self._index_transactions(transactions)
+        else:
+            self._load_transactions()
     
     def _load_transactions(self):
         """Load transactions from XML file into memory"""
         try:
             print(f"Loading transactions from {self.xml_file_path}...")
-            self.transactions = parse_sms_xml(self.xml_file_path)
-            
-            # Create ID lookup dictionary and set next ID
-            self.transactions_by_id = {}
-            max_id = 0
-            
-            for transaction in self.transactions:
-                tx_id = str(transaction.get('txn_id', transaction.get('id', 0)))
-                self.transactions_by_id[tx_id] = transaction
-                try:
-                    max_id = max(max_id, int(tx_id))
-                except (ValueError, TypeError):
-                    pass
-            
-            self._next_id = max_id + 1
+            self._index_transactions(parse_sms_xml_mmap(self.xml_file_path))
             print(f"Loaded {len(self.transactions)} transactions into memory")
             
         except Exception as e:
             print(f"Error loading transactions: {e}")
             self.transactions = []
             self.transactions_by_id = {}
+            self.party_index = PartyIndex()
+    
+    def _index_transactions(self, transactions: List[Dict[str, Any]]):
+        """Store transactions and rebuild the ID lookup dictionary"""
+        self.transactions = transactions
+        
+        # Create ID lookup dictionary and set next ID
+        self.transactions_by_id = {}
+        max_id = 0
+        
+        for transaction in self.transactions:
+            tx_id = str(transaction.get('txn_id', transaction.get('id', 0)))
+            self.transactions_by_id[tx_id] = transaction
+            try:
+                max_id = max(max_id, int(tx_id))
+            except (ValueError, TypeError):
+                pass
+        
+        self._next_id = max_id + 1
+        self.party_index.build(self.transactions)
+        self._reconciliation = None
     
     def get_all_transactions(self) -> List[Dict[str, Any]]:
         """Get all transactions"""
@@ -64,6 +90,22 @@ class TransactionManager:
     
     def add_transaction(self, transaction_data: Dict[str, Any]) -> Dict[str, Any]:
         """Add a new transaction"""
+        now = now_millis()
+        
+        # Convert input first so a bad value (ValueError) leaves nothing changed;
+        # dates are stored as epoch milliseconds, ISO strings are accepted on input
+        txn_date = transaction_data.get("txn_date", transaction_data.get("timestamp"))
+        txn_date = to_epoch_millis(txn_date) if txn_date else now
+        amount = float(transaction_data.get("amount", 0.0))
+        for field in TEXT_FIELDS:
+            if field in transaction_data:
+                _text_value(field, transaction_data[field])
+        raw_message = transaction_data.get("raw_message", "")
+        fee = transaction_data.get("fee", extract_fee(raw_message))
+        balance = transaction_data.get("balance", extract_balance(raw_message))
+        fee = float(fee) if fee is not None else None
+        balance = float(balance) if balance is not None else None
+        
         # Generate new ID
         new_id = str(self._next_id)
         self._next_id += 1
@@ -74,17 +116,21 @@ class TransactionManager:
             "transaction_id": transaction_data.get("transaction_id", new_id),
             "sender": transaction_data.get("sender", "Unknown"),
             "receiver": transaction_data.get("receiver", "Unknown"),
-            "amount": float(transaction_data.get("amount", 0.0)),
-            "txn_date": transaction_data.get("txn_date", datetime.now().isoformat()),
+            "amount": amount,
+            "fee": fee,
+            "balance": balance,
+            "txn_date": txn_date,
             "transaction_type": transaction_data.get("transaction_type", "unknown"),
             "status": transaction_data.get("status", "pending"),
-            "raw_message": transaction_data.get("raw_message", ""),
-            "created_at": datetime.now().isoformat()
+            "raw_message": raw_message,
+            "created_at": now
         }
         
         # Add to both storage structures
         self.transactions.append(new_transaction)
         self.transactions_by_id[new_id] = new_transaction
+        self.party_index.add(new_transaction)
+        self._reconciliation = None
         
         return new_transaction
     
@@ -97,18 +143,30 @@ class TransactionManager:
         # Update allowed fields
         updatable_fields = [
             "sender", "receiver", "amount", "transaction_type", 
-            "status", "raw_message", "txn_date"
+            "status", "raw_message", "txn_date", "fee", "balance"
         ]
         
+        # Convert everything before touching the record, so a bad value
+        # (ValueError) leaves both the record and the party index unchanged
+        changes = {}
         for field in updatable_fields:
             if field in update_data:
                 if field == "amount":
-                    transaction[field] = float(update_data[field])
+                    changes[field] = float(update_data[field])
+                elif field in ("fee", "balance"):
+                    value = update_data[field]
+                    changes[field] = float(value) if value is not None else None
+                elif field == "txn_date":
+                    changes[field] = to_epoch_millis(update_data[field])
                 else:
-                    transaction[field] = update_data[field]
+                    changes[field] = _text_value(field, update_data[field])
         
-        # Update timestamp
-        transaction["updated_at"] = datetime.now().isoformat()
+        # Counterparty or date may change, so re-file it in the party ledgers
+        self.party_index.remove(tx_id)
+        transaction.update(changes)
+        transaction["updated_at"] = now_millis()
+        self.party_index.add(transaction)
+        self._reconciliation = None
         
         return transaction
     
@@ -121,19 +179,56 @@ class TransactionManager:
         # Remove from both storage structures
         self.transactions = [t for t in self.transactions if str(t.get('txn_id', t.get('id'))) != str(tx_id)]
         del self.transactions_by_id[str(tx_id)]
+        self.party_index.remove(tx_id)
+        self._reconciliation = None
         
         return True
     
+    def apply_record(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Insert or replace a complete transaction record as-is
+        (used to replay writes made by another process)
+        """
+        tx_id = str(record.get('txn_id', record.get('id')))
+        transaction = self.transactions_by_id.get(tx_id)
+        self.party_index.remove(tx_id)
+        if transaction is None:
+            transaction = dict(record)
+            self.transactions.append(transaction)
+            self.transactions_by_id[tx_id] = transaction
+        else:
+            # Replace in place so the list and the ID lookup keep sharing one dict
+            transaction.clear()
+            transaction.update(record)
+        self.party_index.add(transaction)
+        self._reconciliation = None
+        try:
+            self._next_id = max(self._next_id, int(tx_id) + 1)
+        except (ValueError, TypeError):
+            pass
+        return transaction
+
     def get_transactions_count(self) -> int:
         """Get total number of transactions"""
         return len(self.transactions)
     
     def search_transactions(self, **filters) -> List[Dict[str, Any]]:
-        """Search transactions by various criteria"""
+        """
+        Search transactions by various criteria
+        date_from/date_to take epoch milliseconds or ISO strings (a date-only
+        date_to includes that whole day); sort="date" or
+        "-date" orders the results by txn_date
+        """
         results = self.transactions.copy()
         
         for field, value in filters.items():
-            if field == "amount_min":
+            if field == "date_from":
+                start = to_epoch_millis(value)
+                results = [t for t in results if t.get("txn_date", 0) >= start]
+            elif field == "date_to":
+                end = to_epoch_millis(value, end_of_day=True)
+                results = [t for t in results if t.get("txn_date", 0) <= end]
+            elif field == "amount_min":
                 results = [t for t in results if t.get("amount", 0) >= float(value)]
             elif field == "amount_max":
                 results = [t for t in results if t.get("amount", 0) <= float(value)]
@@ -146,8 +241,34 @@ class TransactionManager:
             elif field == "receiver":
                 results = [t for t in results if str(value).lower() in t.get("receiver", "").lower()]
         
+        sort = filters.get("sort")
+        if sort in ("date", "-date"):
+            results.sort(key=lambda t: t.get("txn_date", 0), reverse=(sort == "-date"))
+        
         return results
     
+    def get_parties(self) -> List[Dict[str, Any]]:
+        """Get all counterparties with their totals"""
+        return self.party_index.get_parties()
+    
+    def get_party(self, party_id: str) -> Optional[Dict[str, Any]]:
+        """Get a single counterparty by its canonical id"""
+        return self.party_index.get_party(party_id)
+    
+    def get_party_ledger(self, party_id: str, date_from=None, date_to=None) -> Optional[List[Dict[str, Any]]]:
+        """Get the time-ordered ledger of a counterparty (None if unknown)"""
+        return self.party_index.get_ledger(
+            party_id,
+            to_epoch_millis(date_from) if date_from else None,
+            to_epoch_millis(date_to, end_of_day=True) if date_to else None,
+        )
+    
+    def get_reconciliation(self) -> Dict[str, Any]:
+        """Reconcile SMS balances; the result is reused until the data changes"""
+        if self._reconciliation is None:
+            self._reconciliation = reconcile(self.transactions)
+        return self._reconciliation
+    
     def get_transaction_stats(self) -> Dict[str, Any]:
         """Get transaction statistics"""
         if not self.transactions:
@@ -175,7 +296,7 @@ class TransactionManager:
         (Only use this for backup/export purposes)
         """
         try:
-            os.makedirs(os.path.dirname(json_path), exist_ok=True)
+            os.makedirs(os.path.dirname(json_path) or ".", exist_ok=True)
             with open(json_path, 'w', encoding='utf-8') as f:
                 json.dump(self.transactions, f, indent=2, ensure_ascii=False)
             print(f"Transactions exported to: {json_path}")
@@ -1,8 +1,12 @@
+import html
 import json
+import mmap
 import os
 import re
+import time
 import xml.etree.ElementTree as ET
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
 
 DATA_FILE_NAME = "modified_sms_v2.xml"
@@ -10,6 +14,13 @@ DATA_FILE_NAME = "modified_sms_v2.xml"
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "API")
 DATA_FILE_PATH = os.path.join(DATA_DIR, DATA_FILE_NAME)
 
+# Byte-level tokens for the mmap reader: one <sms .../> element (quoted values
+# may contain '>') and the only two attributes we actually use
+_SMS_ELEMENT = re.compile(rb'<sms\b(?:\s+[\w:.-]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*/?>')
+_BODY_ATTR = re.compile(rb'\sbody\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_DATE_ATTR = re.compile(rb'\sdate\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_ATTR_WHITESPACE = re.compile(r'[\t\n\r]')
+
 
 def _parse_amount(body_text):
     """Extract amount from SMS body text"""
@@ -17,10 +28,11 @@ def _parse_amount(body_text):
         return 0.0
     
     # Look for patterns like "2000 RWF", "1,000 RWF", "10,900 RWF"
+    # (the lookbehind stops "2000 RWF" from matching as "000 RWF")
     amount_patterns = [
-        r'(\d{1,3}(?:,\d{3})*(?:\.\d{2})?)\s*RWF',  # Standard RWF format
-        r'(\d+(?:,\d{3})*(?:\.\d{2})?)\s*RWF',      # Any RWF format
-        r'(\d{1,3}(?:,\d{3})*(?:\.\d{2})?)',        # Just numbers with commas
+        r'(?<![\d,])(\d+(?:,\d{3})*(?:\.\d{2})?)\s*RWF',      # Any RWF format
+        r'RWF\s*(\d+(?:,\d{3})*(?:\.\d{2})?)',                 # Currency first, e.g. "RWF 25000"
+        r'(?<![\d,])(\d{1,3}(?:,\d{3})*(?:\.\d{2})?)',        # Just numbers with commas
     ]
     
     for pattern in amount_patterns:
@@ -104,17 +116,108 @@ def _extract_sender_receiver(body_text, transaction_type):
     return sender, receiver
 
 
-def _convert_timestamp(date_str):
-    """Convert timestamp from milliseconds to ISO format"""
+def _parse_labelled_amount(body_text, pattern):
+    """Extract the RWF figure that follows a label such as "new balance" or "Fee was" """
+    if not body_text:
+        return None
+    
+    match = re.search(pattern, body_text, re.IGNORECASE)
+    if match:
+        try:
+            return float(match.group(1).replace(',', ''))
+        except ValueError:
+            return None
+    
+    return None
+
+
+def extract_balance(body_text):
+    """Extract the account balance, e.g. "Your new balance: 1,000 RWF" or "NEW BALANCE :40400 RWF" """
+    return _parse_labelled_amount(body_text, r'new balance\s*(?::|is)\s*(\d[\d,]*(?:\.\d+)?)\s*RWF')
+
+
+def extract_fee(body_text):
+    """Extract the fee, e.g. "Fee was 0 RWF", "Fee was: 100 RWF" or "Fee paid: 350 RWF" """
+    return _parse_labelled_amount(body_text, r'Fee (?:was|paid)\s*:?\s*(\d[\d,]*(?:\.\d+)?)\s*RWF')
+
+
+def extract_counterparty_phone(body_text):
+    """Extract the phone token next to the counterparty, e.g. (*********013) or (250791666666)"""
+    if not body_text:
+        return None
+    
+    match = re.search(r'\((\*+\d+|\d{9,12})\)', body_text)
+    if match:
+        return match.group(1)
+    
+    return None
+
+
+def now_millis():
+    """Current time as epoch milliseconds"""
+    return time.time_ns() // 1_000_000
+
+
+def _convert_timestamp(date_str, default_millis):
+    """Convert the SMS date attribute (epoch milliseconds) to an int"""
     if not date_str:
-        return datetime.now().isoformat()
+        return default_millis
     
     try:
-        # Convert from milliseconds to seconds
-        timestamp = int(date_str) / 1000
-        return datetime.fromtimestamp(timestamp).isoformat()
+        return int(date_str)
     except (ValueError, TypeError):
-        return datetime.now().isoformat()
+        return default_millis
+
+
+def to_epoch_millis(value, end_of_day=False):
+    """
+    Convert epoch milliseconds (int or digit string) or an ISO date string to an int
+    With end_of_day, a date without a time (2024-05-31) means the last millisecond
+    of that day, so it can be used as an inclusive upper bound
+    Raises ValueError for anything that is not a date the server can render back
+    """
+    if isinstance(value, bool):
+        raise ValueError("Invalid timestamp: %r" % value)
+    try:
+        millis = _parse_epoch_millis(value, end_of_day)
+    except OverflowError:
+        raise ValueError("Timestamp out of range: %r" % value) from None
+    # Stored dates must render back as dates
+    try:
+        datetime.fromtimestamp(millis / 1000)
+    except (OverflowError, OSError, ValueError):
+        raise ValueError("Timestamp out of range: %r" % value) from None
+    return millis
+
+
+def _parse_epoch_millis(value, end_of_day):
+    if isinstance(value, (int, float)):
+        return int(value)
+    
+    text = str(value).strip()
+    if text.isdigit():
+        return int(text)
+    
+    # fromisoformat only understands "Z" from Python 3.11 on
+    if text[-1:] in ("Z", "z"):
+        text = text[:-1] + "+00:00"
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        raise ValueError("Invalid date: %r" % value) from None
+    if end_of_day and len(text) == 10:
+        return round((parsed + timedelta(days=1)).timestamp() * 1000) - 1
+    return round(parsed.timestamp() * 1000)
+
+
+def millis_to_iso(millis):
+    """Render epoch milliseconds as a local ISO string with its UTC offset"""
+    return datetime.fromtimestamp(millis / 1000, tz=timezone.utc).astimezone().isoformat()
+
+
+# created_at is one stamp per ingestion batch, so it repeats across records;
+# txn_date values are practically unique and go through millis_to_iso uncached
+stamp_to_iso = lru_cache(maxsize=256)(millis_to_iso)
 
 
 def _extract_transaction_id(body_text):
@@ -137,29 +240,19 @@ def _extract_transaction_id(body_text):
     return None
 
 
-def parse_sms_xml(file_path=DATA_FILE_PATH):
-    """Parse SMS XML file and extract transaction data formatted for database schema"""
-    if not os.path.exists(file_path):
-        raise FileNotFoundError("Data file not found: %s" % file_path)
-
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-
+def _build_records(messages):
+    """Turn (body, date) pairs of financial SMS into transaction records"""
     transactions = []
     transaction_id = 1
+    # One ingestion time for the whole batch
+    created_at = now_millis()
 
-    for sms in root.findall(".//sms"):
-        body = sms.get('body', '')
-        
-        # Skip non-financial SMS
-        if not body or 'RWF' not in body:
-            continue
-        
+    for body, date_str in messages:
         # Extract transaction details
         transaction_type = _extract_transaction_type(body)
         amount = _parse_amount(body)
         sender, receiver = _extract_sender_receiver(body, transaction_type)
-        timestamp = _convert_timestamp(sms.get('date', ''))
+        timestamp = _convert_timestamp(date_str, created_at)
         tx_id = _extract_transaction_id(body) or str(transaction_id)
         
         # Skip if no meaningful amount found
@@ -173,11 +266,13 @@ def parse_sms_xml(file_path=DATA_FILE_PATH):
             "sender": sender,
             "receiver": receiver,
             "amount": amount,
+            "fee": extract_fee(body),
+            "balance": extract_balance(body),  # None when the SMS has no balance figure
             "txn_date": timestamp,
             "transaction_type": transaction_type,
             "status": "completed",  # Most SMS notifications are for completed transactions
             "raw_message": body,
-            "created_at": datetime.now().isoformat()
+            "created_at": created_at
         }
         
         transactions.append(record)
@@ -186,6 +281,78 @@ def parse_sms_xml(file_path=DATA_FILE_PATH):
     return transactions
 
 
+def parse_sms_xml(file_path=DATA_FILE_PATH):
+    """Parse SMS XML file and extract transaction data formatted for database schema"""
+    if not os.path.exists(file_path):
+        raise FileNotFoundError("Data file not found: %s" % file_path)
+
+    tree = ET.parse(file_path)
+    root = tree.getroot()
+
+    def financial_messages():
+        for sms in root.findall(".//sms"):
+            body = sms.get('body', '')
+            # Skip non-financial SMS
+            if not body or 'RWF' not in body:
+                continue
+            yield body, sms.get('date', '')
+
+    return _build_records(financial_messages())
+
+
+def _decode_attr(raw):
+    """Decode an XML attribute value the way ElementTree would"""
+    value = raw.decode("utf-8")
+    if "&" not in value and "\t" not in value and "\n" not in value and "\r" not in value:
+        return value
+    # Literal whitespace is normalized to spaces before entities are expanded
+    return html.unescape(_ATTR_WHITESPACE.sub(" ", value))
+
+
+def _attr_span(match):
+    """Start/end offsets of whichever quote style the attribute used"""
+    group = 1 if match.start(1) != -1 else 2
+    return match.start(group), match.end(group)
+
+
+def iter_financial_sms(file_path=DATA_FILE_PATH):
+    """
+    Yield (body, date) for every financial SMS by scanning an mmap of the file
+    Messages without "RWF" are skipped before anything is decoded
+    """
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for element in _SMS_ELEMENT.finditer(data):
+                start, end = element.span()
+                body_match = _BODY_ATTR.search(data, start, end)
+                if not body_match:
+                    continue
+                body_start, body_end = _attr_span(body_match)
+                if body_start == body_end or data.find(b"RWF", body_start, body_end) == -1:
+                    continue
+
+                date_match = _DATE_ATTR.search(data, start, end)
+                date_str = ""
+                if date_match:
+                    date_start, date_end = _attr_span(date_match)
+                    date_str = _decode_attr(data[date_start:date_end])
+
+                yield _decode_attr(data[body_start:body_end]), date_str
+
+
+def parse_sms_xml_mmap(file_path=DATA_FILE_PATH):
+    """
+    Same output as parse_sms_xml, but reads the file through mmap and a
+    byte-level tokenizer instead of building an ElementTree (for large backups)
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError("Data file not found: %s" % file_path)
+
+    return _build_records(iter_financial_sms(file_path))
+
+
 def save_as_json(output_path, records):
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     with open(output_path, "w", encoding="utf-8") as f:
@@ -193,7 +360,7 @@ def save_as_json(output_path, records):
 
 
 if __name__ == "__main__":
-    parsed = parse_sms_xml()
+    parsed = parse_sms_xml_mmap()
     out = os.path.join(DATA_DIR, "parsed_sms.json")
     save_as_json(out, parsed)
     print("Parsed %d transactions -> %s" % (len(parsed), out))